@@ -3,12 +3,25 @@ from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import requests
 import io
 import re
 from weasyprint import HTML as WPHTML
 import json  # Added for JSONDecodeError
 import html  # Used for escaping HTML content
+import random
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from spellchecker import SpellChecker  # Optional: pip install pyspellchecker
+except ImportError:
+    SpellChecker = None
 
 app = FastAPI()
 
@@ -18,22 +31,186 @@ app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
 
-# Modified call_ollama to accept url and model
-def call_ollama(prompt, ollama_base_url, model_name):
-    """Calls the Ollama chat API."""
+# Timeouts and retry budget for Ollama chat calls. The connect timeout is short so a
+# dead server fails fast; the read timeout is the longest wait for the next streamed token.
+OLLAMA_CONNECT_TIMEOUT = 5
+OLLAMA_READ_TIMEOUT = 120
+OLLAMA_DEADLINE_SECONDS = 300  # Total budget for one grading request, retries included
+OLLAMA_MAX_ATTEMPTS = 3
+OLLAMA_RETRY_BASE_DELAY = 1.0
+# Chat requests have no side effects, so these failures are safe to retry
+OLLAMA_RETRYABLE_STATUS_CODES = {408, 429, 502, 503, 504}
+
+# Recent call durations per (server, model), in seconds per 1k prompt characters so long and
+# short essays share one hedging threshold. Calls cancelled by a hedge count as lower bounds
+OLLAMA_LATENCY_SAMPLES = 50
+OLLAMA_MIN_SAMPLES_FOR_HEDGE = 5
+_ollama_latencies = {}
+_ollama_latencies_lock = threading.Lock()
+
+
+class _OllamaCancelled(Exception):
+    """Raised inside a hedged attempt once the other server has already answered."""
+
+
+def _prompt_size_k(data):
+    # Prompts under 1k characters count as 1k so tiny prompts do not get tiny thresholds
+    return max(len(data['messages'][-1]['content']) / 1000, 1)
+
+
+def _record_latency(ollama_base_url, data, seconds):
+    key = (ollama_base_url.rstrip('/'), data['model'])
+    with _ollama_latencies_lock:
+        _ollama_latencies.setdefault(key, deque(maxlen=OLLAMA_LATENCY_SAMPLES)).append(seconds / _prompt_size_k(data))
+
+
+def _hedge_delay(ollama_base_url, data):
+    """Returns the p95 duration expected for this prompt on this server and model, or None if too few samples."""
+    key = (ollama_base_url.rstrip('/'), data['model'])
+    with _ollama_latencies_lock:
+        samples = sorted(_ollama_latencies.get(key, ()))
+    if len(samples) < OLLAMA_MIN_SAMPLES_FOR_HEDGE:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))] * _prompt_size_k(data)
+
+
+def _stream_ollama_chat(ollama_api_url, data, timeout, deadline, cancel):
+    """Streams one chat response, giving up when cancelled or past the deadline.
+
+    Each attempt uses its own Session. Leaving the with-blocks closes the connection,
+    which makes Ollama stop generating for an abandoned request.
+    """
+    parts = []
+    with requests.Session() as session:
+        with session.post(ollama_api_url, json=data, timeout=timeout, stream=True) as r:
+            if r.status_code >= 400:
+                r.content  # Read the error body before the connection is closed
+            r.raise_for_status()  # Raises HTTPError for bad responses (4xx or 5xx)
+            for line in r.iter_lines():
+                if cancel.is_set():
+                    raise _OllamaCancelled()
+                if time.monotonic() > deadline:
+                    raise requests.exceptions.Timeout("Ollama request deadline exceeded while generating.")
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if 'error' in chunk:
+                    raise RuntimeError(f"Ollama API error: {chunk['error']}")
+                parts.append(chunk.get('message', {}).get('content', ''))
+                if chunk.get('done'):
+                    break
+    return "".join(parts)
+
+
+def _post_ollama_chat(ollama_base_url, data, deadline, cancel=None):
+    """Posts a chat request, retrying transient failures with jittered backoff until the deadline."""
     ollama_api_url = f"{ollama_base_url.rstrip('/')}/api/chat"
+    cancel = cancel or threading.Event()
+    last_error = None
+    for attempt in range(OLLAMA_MAX_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if cancel.is_set():
+            raise _OllamaCancelled()
+        # Never let a single attempt run past the overall deadline
+        timeout = (min(OLLAMA_CONNECT_TIMEOUT, remaining), min(OLLAMA_READ_TIMEOUT, remaining))
+        print(f"--- Calling Ollama API ({data['model']}) at {ollama_api_url} (attempt {attempt + 1}) ---")  # Console log
+        start = time.monotonic()
+        try:
+            content = _stream_ollama_chat(ollama_api_url, data, timeout, deadline, cancel)
+            _record_latency(ollama_base_url, data, time.monotonic() - start)
+            print("--- Ollama API Response Received ---")  # Console log
+            return content
+        except _OllamaCancelled:
+            # The other hedged request answered first. This one took at least this long, and
+            # leaving it out would drop exactly the slow calls from the p95 window
+            _record_latency(ollama_base_url, data, time.monotonic() - start)
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            print(f"Ollama API transient error on attempt {attempt + 1}: {e}")  # Console log
+            last_error = e
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code not in OLLAMA_RETRYABLE_STATUS_CODES:
+                raise
+            print(f"Ollama API returned HTTP {e.response.status_code} on attempt {attempt + 1}")  # Console log
+            last_error = e
+
+        if attempt + 1 < OLLAMA_MAX_ATTEMPTS:
+            # Full jitter keeps parallel graders from retrying in lockstep
+            delay = random.uniform(0, OLLAMA_RETRY_BASE_DELAY * (2 ** attempt))
+            cancel.wait(max(0, min(delay, deadline - time.monotonic())))
+
+    if last_error is None:
+        last_error = requests.exceptions.Timeout("Ollama request deadline exceeded before the call could be made.")
+    raise last_error
+
+
+def _post_ollama_chat_hedged(ollama_base_url, hedge_url, data, deadline):
+    """Sends the request to the primary server and, if it is slower than its usual p95, also to hedge_url.
+
+    The first successful response wins. The other request is cancelled and closes its
+    connection at its next streamed token, so Ollama stops generating it. If the primary
+    fails before its p95, the hedge server is tried straight away.
+    """
+    hedge_delay = _hedge_delay(ollama_base_url, data)
+    if hedge_delay is None:
+        # Not enough history to know what "slow" means yet
+        return _post_ollama_chat(ollama_base_url, data, deadline)
+
+    primary_cancel = threading.Event()
+    hedge_cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        primary = executor.submit(_post_ollama_chat, ollama_base_url, data, deadline, primary_cancel)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done and primary.exception() is None:
+            return primary.result()
+
+        if done:
+            print(f"--- Primary Ollama failed, trying {hedge_url} ---")  # Console log
+        else:
+            print(f"--- Primary Ollama slower than p95 ({hedge_delay:.1f}s), hedging to {hedge_url} ---")  # Console log
+        hedge = executor.submit(_post_ollama_chat, hedge_url, data, deadline, hedge_cancel)
+        pending = {primary, hedge}
+        primary_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    print(f"Hedged Ollama request failed: {e}")  # Console log
+                    if future is primary:
+                        primary_error = e
+        # Both failed: report the primary server's error, as for an unhedged call
+        raise primary_error
+    finally:
+        # Stop whichever request is still running
+        primary_cancel.set()
+        hedge_cancel.set()
+        executor.shutdown(wait=False)
+
+
+# Modified call_ollama to accept url and model
+def call_ollama(prompt, ollama_base_url, model_name, hedge_url=None, deadline_seconds=OLLAMA_DEADLINE_SECONDS):
+    """Calls the Ollama chat API, retrying transient failures within deadline_seconds.
+
+    If hedge_url is given, a second Ollama server is also asked when the first one is
+    slower than its recent p95 for a prompt of this size. This blocks, so call it from
+    a worker thread in async endpoints.
+    """
+    deadline = time.monotonic() + deadline_seconds
     try:
         data = {
             "model": model_name,
             "messages": [{"role": "user", "content": prompt}],
-            "stream": False
+            "stream": True  # Streaming lets an abandoned request be cut off mid-generation
         }
-        print(f"--- Calling Ollama API ({model_name}) at {ollama_api_url} ---")  # Console log
-        r = requests.post(ollama_api_url, json=data, timeout=120)
-        r.raise_for_status()  # Raises HTTPError for bad responses (4xx or 5xx)
-        response_data = r.json()
-        print("--- Ollama API Response Received ---")  # Console log
-        return response_data.get('message', {}).get('content', '')
+        if hedge_url and hedge_url.rstrip('/') != ollama_base_url.rstrip('/'):
+            return _post_ollama_chat_hedged(ollama_base_url, hedge_url, data, deadline)
+        return _post_ollama_chat(ollama_base_url, data, deadline)
     except requests.exceptions.ConnectionError as e:
         print(f"Ollama API Connection Error: {e}")  # Console log specific error
         raise RuntimeError(f"Cannot connect to Ollama server at {ollama_base_url}. Is it running?")
@@ -51,6 +228,8 @@ def call_ollama(prompt, ollama_base_url, model_name):
         except json.JSONDecodeError:
             pass  # Keep the basic HTTP error if JSON parsing fails
         raise RuntimeError(f"Ollama API error: {error_detail}")
+    except RuntimeError:
+        raise  # Already a readable error (e.g. an error reported mid-stream by Ollama)
     except Exception as e:
         print(f"Ollama API Generic Error: {e}")  # Console log other errors
         raise RuntimeError(f"An unexpected error occurred contacting the AI model: {e}")
@@ -62,7 +241,7 @@ async def get_models(ollama_url: str = Form(...)):
     tags_url = f"{ollama_url.rstrip('/')}/api/tags"
     print(f"--- Fetching models from {tags_url} ---")  # Console log
     try:
-        response = requests.get(tags_url, timeout=10)  # Add timeout
+        response = requests.get(tags_url, timeout=(OLLAMA_CONNECT_TIMEOUT, 10))  # Separate connect and read timeouts
         response.raise_for_status()  # Check for HTTP errors
         data = response.json()
         models = sorted([m['name'] for m in data.get('models', [])])  # Sort models alphabetically
@@ -111,6 +290,12 @@ mark {
   padding: 0.1em 0.3em;      /* Padding around AI comments */
   border-radius: 3px;       /* Rounded corners for AI comments */
 }
+mark.ai-comment {
+  margin-left: 0.25em; /* Space from the word the comment follows */
+}
+.annotation-summary {
+  margin-top: 1rem; /* Scores and feedback below the essay */
+}
 .teacher-manual-annotation {
   background-color: #add8e6; /* Light blue background */
   border-bottom: 2px dashed #00008b; /* Dark blue dashed underline */
@@ -181,6 +366,16 @@ textarea { width: 100%; }
               <option value="">-- Enter URL & Fetch --</option>
             </select>
          </div>
+         <div class="input-group mb-2">
+            <span class="input-group-text">Draft Model</span>
+            <select id="draft-model" name="draft_model" class="form-select" disabled>
+              <option value="">-- None (single model) --</option>
+            </select>
+         </div>
+        <div class="input-group mb-2">
+           <span class="input-group-text">Hedge URL</span>
+           <input type="text" id="hedge-url" name="hedge_url" class="form-control" placeholder="Optional second server with the same models">
+        </div>
         <button type="button" id="fetch-models-btn" class="btn btn-secondary btn-sm w-100">Fetch Models</button>
          <div id="model-fetch-error" class="text-danger mt-1" style="font-size: 0.8em;"></div>
       </div>
@@ -259,6 +454,10 @@ textarea { width: 100%; }
         <div class="form-check"><input class="form-check-input" type="checkbox" name="criteria" value="spelling" checked><label class="form-check-label">Spelling</label></div>
         <div class="form-check"><input class="form-check-input" type="checkbox" name="criteria" value="structure"><label class="form-check-label">Structure</label></div>
       </div>
+      <div class="form-check mb-3">
+        <input class="form-check-input" type="checkbox" name="local_prechecks" id="local-prechecks" value="true">
+        <label class="form-check-label" for="local-prechecks">Local pre-checks (spelling, repeated words, readability)</label>
+      </div>
       <div class="card mb-3 p-2">
         <label class="form-label">Rubric Weights (Total <span id="weight-total">100</span>%)</label>
         <div id="weights-container">
@@ -296,6 +495,8 @@ textarea { width: 100%; }
   <div class="col-md-9 mb-3">
     <h5>AI Suggested Grade</h5>
     <input id="grade" type="text" class="form-control mb-2">
+    <div id="review-status" class="text-muted mb-2" style="font-size: 0.9em;"></div>
+    <div id="precheck-summary" class="text-muted mb-2" style="font-size: 0.9em;"></div>
     <h5>Annotated Essay (Editable)</h5>
     <button onclick="flattenTeacherComments()" class="btn btn-outline-primary mb-2">Embed Teacher Comments Inline</button>
     <div id="annotated" contenteditable="true"></div>
@@ -314,66 +515,191 @@ textarea { width: 100%; }
 </html>
 """
 
-# Modify /analyze endpoint to accept ollama_url and ollama_model
-@app.post("/analyze")
-async def analyze(
-    file: UploadFile = File(None),  # Changed to None
-    text_input: str = Form(None),  # Added
-    ollama_url: str = Form(...),  # Added
-    ollama_model: str = Form(...),  # Added
-    criteria: str = Form(""),
-    instructions: str = Form(""),
-    tone: str = Form("formal"),
-    strictness: str = Form("balanced"),
-    grade_level: str = Form(""),
-    weight_grammar: int = Form(25),
-    weight_vocabulary: int = Form(25),
-    weight_coherence: int = Form(25),
-    weight_spelling: int = Form(25),
-    weight_structure: int = Form(0)
-):
-    content = None
-    if text_input:
-        content = text_input
-        print("--- Received text input from textarea ---")  # Console log
-    elif file:
-        try:
-            file_content_bytes = await file.read()
-            content = file_content_bytes.decode("utf-8")
-            print(f"--- Received file upload: {file.filename} ---")  # Console log
-        except Exception as e:
-            print(f"Error reading uploaded file: {e}")
-            raise HTTPException(status_code=400, detail=f"Invalid file upload or encoding: {e}")
-    else:
-        # This case should ideally be caught by frontend validation, but good to have backend check
-        print("Error: Neither file nor text_input provided.")  # Console log
-        raise HTTPException(status_code=400, detail="No essay content provided. Please upload a file or paste text.")
+SCORE_CRITERIA = ["Grammar", "Vocabulary", "Coherence", "Spelling", "Structure"]
 
-    if not content:  # Should be redundant if logic above is correct, but as a safeguard
-        print("Error: Content is empty after checks.")  # Console log
-        raise HTTPException(status_code=400, detail="Essay content is empty.")
+# How far the reported grade may drift from the weighted rubric scores before a
+# draft is considered inconsistent and sent to the review model
+DRAFT_GRADE_TOLERANCE = 5
 
-    # Basic validation for weights (optional but good practice)
-    total_weight = weight_grammar + weight_vocabulary + weight_coherence + weight_spelling + weight_structure
-    if total_weight != 100:
-        print(f"Warning: Rubric weights do not sum to 100 (Sum: {total_weight})")  # Console log
-        # Decide if you want to raise an error or just proceed
-        # raise HTTPException(status_code=400, detail=f"Rubric weights must sum to 100, current sum is {total_weight}")
 
-    rubric = f"""
+# Local pre-checks run before the prompt is built so the model does not have to
+# spend output tokens on mechanical issues a dictionary can find
+# Any letters, including accented ones; essays pasted from Word use curly apostrophes
+PRECHECK_WORD_RE = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+PRECHECK_REPEATED_RE = re.compile(r"\b([^\W\d_]+)\s+\1\b", re.IGNORECASE)
+PRECHECK_ALLOWED_REPEATS = {"had", "that"}  # "had had" and "that that" are often correct
+# pyspellchecker's dictionary is US English. These rewrite British spellings to the US form;
+# if the dictionary knows the result, the word is a regional variant and not a mistake.
+REGIONAL_VARIANT_RULES = [
+    (r"our(s|ed|ing|ful|ite|ites|able)?$", r"or\1"),  # colour, behaviour, favourite
+    (r"is(e|es|ed|ing|ation|ations)$", r"iz\1"),  # organise, realised, organisation
+    (r"ys(e|es|ed|ing)$", r"yz\1"),  # analyse
+    (r"tre(s)?$", r"ter\1"),  # centre, metres
+    (r"ll(ed|ing|er|ers)$", r"l\1"),  # travelled, modelling
+    (r"ogue(s)?$", r"og\1"),  # catalogue
+    (r"ence(s)?$", r"ense\1"),  # defence, licence
+    (r"ae", "e"),  # paediatric
+    (r"oe", "e"),  # oestrogen
+]
+_spell_checker = None
+
+
+def get_spell_checker():
+    """Returns a shared SpellChecker, or None if pyspellchecker is not installed."""
+    global _spell_checker
+    if _spell_checker is None and SpellChecker is not None:
+        _spell_checker = SpellChecker(distance=1)  # Distance 1 keeps suggestions fast
+    return _spell_checker
+
+
+def count_syllables(word):
+    """Rough syllable count used for readability statistics."""
+    word = word.lower()
+    syllables = len(re.findall(r"[aeiouy]+", word))
+    if word.endswith("e") and not word.endswith(("le", "ee")) and syllables > 1:
+        syllables -= 1  # Silent final e
+    return max(1, syllables)
+
+
+def strip_possessive(word):
+    """Returns the word a possessive is built on ("women's" -> "women"), or the word itself."""
+    if word.endswith("'s"):
+        return word[:-2]
+    if word.endswith("s'"):
+        return word[:-1]
+    return word
+
+
+def find_regional_variants(words, checker):
+    """Returns the words that are British spellings of words the US English dictionary knows."""
+    rewrites = {}
+    for word in words:
+        for pattern, replacement in REGIONAL_VARIANT_RULES:
+            us_spelling = re.sub(pattern, replacement, word)
+            if us_spelling != word:
+                rewrites.setdefault(word, set()).add(us_spelling)
+    known = checker.known({us for alternatives in rewrites.values() for us in alternatives})
+    return {word for word, alternatives in rewrites.items() if alternatives & known}
+
+
+def spelling_is_graded(criteria, weights):
+    """True when Spelling is a selected criterion with a non-zero weight."""
+    selected = {c.strip().lower() for c in criteria.split(",")}
+    return "spelling" in selected and weights.get("spelling", 0) > 0
+
+
+def run_local_prechecks(content, check_spelling=True):
+    """Finds misspelled and repeated words offline and computes readability statistics for the essay."""
+    words = [w.replace("’", "'") for w in PRECHECK_WORD_RE.findall(content)]
+
+    misspelled = {}
+    checker = get_spell_checker() if check_spelling else None
+    if checker is not None:
+        # Capitalized words are skipped since they are often names the dictionary does not know.
+        # All unique candidates are looked up in a single batch instead of word by word.
+        candidates = {w.lower() for w in words if w[0].islower() and len(w) > 1}
+        unknown = checker.unknown(candidates)
+        # Possessives such as "women's" are not dictionary entries, so check the word they are built on
+        bases = {w: strip_possessive(w) for w in unknown}
+        unknown_bases = checker.unknown(set(bases.values()))
+        unknown_bases -= find_regional_variants(unknown_bases, checker)
+        for word in sorted(w for w in unknown if bases[w] in unknown_bases):
+            misspelled[word] = checker.correction(word)
+
+    repeated = sorted({
+        m.group(1).lower() for m in PRECHECK_REPEATED_RE.finditer(content)
+        if m.group(1).lower() not in PRECHECK_ALLOWED_REPEATS
+    })
+
+    sentence_count = max(1, len([s for s in re.split(r"[.!?]+", content) if PRECHECK_WORD_RE.search(s)]))
+    word_count = len(words)
+    readability = {"words": word_count, "sentences": sentence_count}
+    if word_count:
+        words_per_sentence = word_count / sentence_count
+        syllables_per_word = sum(count_syllables(w) for w in words) / word_count
+        readability["avg_sentence_length"] = round(words_per_sentence, 1)
+        readability["flesch_reading_ease"] = round(206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word, 1)
+        readability["flesch_kincaid_grade"] = round(0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59, 1)
+
+    print(f"--- Local pre-checks: {len(misspelled)} misspelled, {len(repeated)} repeated, readability {readability} ---")  # Console log
+    return {
+        "spell_checker_available": SpellChecker is not None,
+        "spelling_checked": checker is not None,
+        "misspelled": misspelled,
+        "repeated_words": repeated,
+        "readability": readability,
+    }
+
+
+def build_precheck_note(prechecks):
+    """Tells the model which issues the local pre-checks already annotated."""
+    lines = []
+    if prechecks["misspelled"] or prechecks["repeated_words"]:
+        lines.append("The following issues have ALREADY been annotated automatically. Do NOT add [Comment: ...] annotations for them. Use your own judgement on whether they affect any score:")
+        if prechecks["misspelled"]:
+            lines.append("- Words not in the spelling dictionary: " + ", ".join(prechecks["misspelled"]))
+        if prechecks["repeated_words"]:
+            lines.append("- Repeated words: " + ", ".join(f"{w} {w}" for w in prechecks["repeated_words"]))
+    readability = prechecks["readability"]
+    if "flesch_kincaid_grade" in readability:
+        lines.append(
+            f"Readability statistics (computed, do not recalculate): {readability['words']} words, "
+            f"{readability['sentences']} sentences, average sentence length {readability['avg_sentence_length']} words, "
+            f"Flesch reading ease {readability['flesch_reading_ease']}, Flesch-Kincaid grade {readability['flesch_kincaid_grade']}."
+        )
+    return "\n".join(lines)
+
+
+def find_precheck_comments(original, prechecks):
+    """Returns the local pre-check issues as comments anchored in the original essay."""
+    comments = {}
+    for word in prechecks["repeated_words"]:
+        comments[f"{word} {word}"] = f"[Comment: Repeated word \"{word}\".]"
+    for word, suggestion in prechecks["misspelled"].items():
+        if suggestion and suggestion != word:
+            comments[word] = f"[Comment: Spelling: \"{word}\" is not in the dictionary; did you mean \"{suggestion}\"?]"
+        else:
+            comments[word] = f"[Comment: Spelling: \"{word}\" is not in the dictionary.]"
+    if not comments:
+        return []
+
+    # One pass over the text for all issues; repeated pairs come first so they win over single words
+    alternatives = [
+        re.escape(k).replace(r"\ ", r"\s+").replace("'", "['’]")  # Keys use straight apostrophes
+        for k in sorted(comments, key=len, reverse=True)
+    ]
+    issue_re = re.compile(r"\b(?:" + "|".join(alternatives) + r")\b", re.IGNORECASE)
+
+    found = []
+    for m in issue_re.finditer(original):
+        key = " ".join(m.group(0).lower().replace("’", "'").split())
+        if key in comments:
+            found.append({"start": m.end(), "end": m.end(), "text": comments[key], "source": "precheck"})
+    return found
+
+
+def build_rubric(weights):
+    """Returns the rubric section shared by the grading and review prompts."""
+    return f"""
 Grading Rubric and Weights:
-- Grammar (sentence structure, punctuation, subject-verb agreement): {weight_grammar}%
-- Vocabulary (word choice, variety, appropriateness): {weight_vocabulary}%
-- Coherence (logical flow, transitions, clarity): {weight_coherence}%
-- Spelling (correct spelling): {weight_spelling}%
-- Structure (organization: intro, body, conclusion): {weight_structure}%
+- Grammar (sentence structure, punctuation, subject-verb agreement): {weights['grammar']}%
+- Vocabulary (word choice, variety, appropriateness): {weights['vocabulary']}%
+- Coherence (logical flow, transitions, clarity): {weights['coherence']}%
+- Spelling (correct spelling): {weights['spelling']}%
+- Structure (organization: intro, body, conclusion): {weights['structure']}%
 """
-    prompt = f"""
+
+
+def build_grading_prompt(content, grade_level, tone, strictness, criteria, instructions, weights, precheck_note=""):
+    """Builds the grading prompt sent to the model for a single essay."""
+    rubric = build_rubric(weights)
+    return f"""
 You are an experienced English teacher grading a {grade_level} student's essay.
 Your tone should be {tone}. Be {strictness}.
 {rubric}
 Focus on these criteria: {criteria}.
 {instructions if instructions else ''}
+{precheck_note}
 Please follow these instructions VERY carefully:
 1. DO NOT rewrite or paraphrase the essay content itself. Only add comments.
 2. For every correction, suggestion, or observation you make about the text, you MUST immediately insert an inline comment enclosed exactly like this: [Comment: your comment here]. Place the comment directly after the text it refers to. Do not add comments anywhere else.
@@ -399,61 +725,233 @@ Now, grade this essay strictly following all the rules above:
 {content}
 --- ESSAY END ---
 """
-    print("--- Preparing to call Ollama for analysis ---")  # Console log
+
+
+REVIEW_ANCHOR_CHARS = 40  # Essay text shown before each draft comment in the review prompt
+
+
+def reviewable_comments(comments):
+    """Returns the model comments the reviewer may change, in the order they are numbered in the review prompt."""
+    # Pre-check comments come from the local checks, not the draft, so they are never up for review
+    return [c for c in comments if c["source"] == "ai"]
+
+
+def build_review_prompt(content, grade_level, tone, strictness, criteria, instructions, weights, precheck_note, draft, problems):
+    """Builds the prompt asking the larger model to correct a draft grading without repeating the essay."""
+    problem_lines = "\n".join(f"- {p}" for p in problems)
+    comment_lines = []
+    for number, comment in enumerate(reviewable_comments(draft["comments"]), 1):
+        anchor = " ".join(content[max(0, comment["start"] - REVIEW_ANCHOR_CHARS):comment["start"]].split())
+        comment_lines.append(f'{number}. after "{anchor}": {comment["text"]}')
+    return f"""
+You are an experienced English teacher reviewing a draft grading of a {grade_level} student's essay that a faster assistant produced.
+Your tone should be {tone}. Be {strictness}.
+{build_rubric(weights)}
+Focus on these criteria: {criteria}.
+{instructions if instructions else ''}
+{precheck_note}
+The following problems were detected in the draft:
+{problem_lines}
+
+--- ESSAY START ---
+{content}
+--- ESSAY END ---
+
+Draft inline comments (number, the essay text the comment follows, comment):
+{chr(10).join(comment_lines) if comment_lines else "(none)"}
+
+Draft scores and feedback:
+{draft["summary"].strip() or "(none)"}
+
+Please follow these instructions VERY carefully:
+1. DO NOT repeat the essay. Correct comments are kept automatically, so do not list them.
+2. Start with a line "Comment changes:" followed by one change per line, or the word None:
+   REMOVE n
+   REPLACE n: [Comment: corrected comment]
+   ADD after "short exact quote from the essay": [Comment: new comment]
+3. Then output the corrected rubric scores (scale 0-100) with each score on a new line in the exact format:
+   Grammar: XX
+   Vocabulary: XX
+   Coherence: XX
+   Spelling: XX
+   Structure: XX
+4. Immediately after the rubric scores, output the overall weighted grade on a new line in the exact format:
+   Grade: YY/100
+5. Finally, include three sections exactly in this order (each starting on a new line with the header followed by the content on the next line(s)):
+   Strengths:
+   [List strengths here]
+   Weaknesses:
+   [List weaknesses here]
+   Suggestions for improvement:
+   [List suggestions here]
+"""
+
+
+async def request_ai_response(prompt, ollama_url, model_name, hedge_url="", context="/analyze"):
+    """Calls Ollama and converts failures into HTTP errors for the endpoints."""
     try:
-        # Pass ollama_url and ollama_model to the call function
-        ai_response = call_ollama(prompt, ollama_url, ollama_model)
+        # call_ollama blocks for up to its whole deadline, so keep it off the event loop
+        ai_response = await run_in_threadpool(call_ollama, prompt, ollama_url, model_name, hedge_url=hedge_url or None)
         if not ai_response:  # Handle empty response from Ollama
             print("Error: Received empty response from Ollama.")  # Console log
             raise RuntimeError("AI model returned an empty response.")
-
-        print("--- AI Response Received, Processing... ---")  # Console log
-        # print(f"Raw AI Response:\n{ai_response}\n--- End Raw AI Response ---") # Optional: log raw response for debugging
-
+        return ai_response
     except RuntimeError as e:
         # Error already printed in call_ollama, just raise HTTP exception
-        print(f"Error during Ollama call in /analyze: {e}")  # Console log specific context
+        print(f"Error during Ollama call in {context}: {e}")  # Console log specific context
         raise HTTPException(status_code=503, detail=str(e))  # Send error detail to frontend
     except Exception as e:
         # Catch any other unexpected errors during the call
-        print(f"Unexpected error calling Ollama in /analyze: {e}")  # Console log
+        print(f"Unexpected error calling Ollama in {context}: {e}")  # Console log
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred during AI analysis: {e}")
 
-    # --- Process AI Response ---
+
+COMMENT_RE = re.compile(r'\[Comment:\s*.*?\]', re.IGNORECASE | re.DOTALL)
+ESSAY_WORD_RE = re.compile(r"\S+")
+
+
+def extract_comments(annotated_text):
+    """Removes the [Comment: ...] annotations, returning the bare text and (offset, comment) pairs."""
+    text_parts = []
+    comments = []
+    length = 0
+    last_end = 0
+    for m in COMMENT_RE.finditer(annotated_text):
+        piece = annotated_text[last_end:m.start()]
+        text_parts.append(piece)
+        length += len(piece)
+        comments.append((length, m.group(0)))
+        last_end = m.end()
+    text_parts.append(annotated_text[last_end:])
+    return "".join(text_parts), comments
+
+
+def align_comments_to_original(essay_text, comments, original):
+    """Maps comment offsets in the model's copy of the essay onto offsets in the original essay.
+
+    The model may change whitespace or a few words while copying the essay, so the two
+    texts are aligned word by word and each comment is attached after the original word
+    that corresponds to the word it followed.
+    """
+    src = [(m.group(0), m.end()) for m in ESSAY_WORD_RE.finditer(essay_text)]
+    dst = [(m.group(0), m.end()) for m in ESSAY_WORD_RE.finditer(original)]
+    src_words = [w for w, _ in src]
+    dst_words = [w for w, _ in dst]
+
+    # Copies are usually identical apart from a few spots, so only diff the part between
+    # the common prefix and suffix
+    prefix = 0
+    limit = min(len(src_words), len(dst_words))
+    while prefix < limit and src_words[prefix] == dst_words[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and src_words[-1 - suffix] == dst_words[-1 - suffix]:
+        suffix += 1
+
+    src_to_dst = list(range(prefix)) + [-1] * (len(src) - prefix)
+    for k in range(suffix):
+        src_to_dst[len(src) - 1 - k] = len(dst) - 1 - k
+    matcher = SequenceMatcher(None, src_words[prefix:len(src) - suffix], dst_words[prefix:len(dst) - suffix])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        for k in range(i1, i2):
+            if tag == "equal":
+                j = j1 + (k - i1)
+            elif j2 > j1:
+                # Changed words map proportionally onto the replaced original words
+                j = j1 + (k - i1) * (j2 - j1) // (i2 - i1)
+            else:
+                j = j1 - 1  # Inserted words attach to the original word before them
+            src_to_dst[prefix + k] = prefix + j
+
+    src_ends = [end for _, end in src]
+    aligned = []
+    for position, text in comments:
+        i = bisect_right(src_ends, position) - 1  # Last word ending before the comment
+        j = src_to_dst[i] if i >= 0 else -1
+        offset = dst[j][1] if j >= 0 else 0
+        aligned.append({"start": offset, "end": offset, "text": text, "source": "ai"})
+    return aligned
+
+
+def render_annotated_html(original, comments, summary=""):
+    """Builds the annotated essay HTML from the original text and offset-based comments.
+
+    AI comments are points ({"start": n, "end": n}); teacher comments cover the range
+    start..end and are shown inline as well when "embedded" is set.
+    """
+    n = len(original)
+    points = {}
+    teacher = []
+    for c in comments:
+        try:
+            start = min(max(int(c.get("start", 0)), 0), n)
+            end = min(max(int(c.get("end", start)), start), n)
+        except (TypeError, ValueError):
+            continue  # Skip malformed comments rather than failing the whole report
+        text = str(c.get("text", ""))
+        if c.get("source") == "teacher" and end > start:
+            teacher.append((start, end, text, bool(c.get("embedded"))))
+        else:
+            points.setdefault(start, []).append(text)
+
+    # Teacher ranges are rendered as disjoint spans; an overlapping range is dropped
+    teacher.sort()
+    disjoint = []
+    for t in teacher:
+        if not disjoint or t[0] >= disjoint[-1][1]:
+            disjoint.append(t)
+
+    cuts = sorted({0, n, *points, *(t[0] for t in disjoint), *(t[1] for t in disjoint)})
+    parts = [f'<mark class="ai-comment">{html.escape(t)}</mark>' for t in points.get(0, [])]
+    t_index = 0
+    for a, b in zip(cuts, cuts[1:]):
+        while t_index < len(disjoint) and disjoint[t_index][1] <= a:
+            t_index += 1
+        piece = html.escape(original[a:b])
+        current = disjoint[t_index] if t_index < len(disjoint) and disjoint[t_index][0] <= a else None
+        if current:
+            parts.append(f'<span class="teacher-manual-annotation">{piece}</span>')
+            if current[1] == b and current[3]:
+                parts.append(f'<mark class="manual-comment-embed"> [Manual Annotation: {html.escape(current[2])}]</mark>')
+        else:
+            parts.append(piece)
+        parts.extend(f'<mark class="ai-comment">{html.escape(t)}</mark>' for t in points.get(b, []))
+    if summary:
+        parts.append("\n\n" + html.escape(summary.strip()))
+    return "".join(parts)
+
+
+SCORE_LINE_RE = re.compile(rf'^[ \t]*(?:{"|".join(SCORE_CRITERIA)}|Grade)\s*:\s*\d', re.IGNORECASE | re.MULTILINE)
+
+
+def split_ai_response(ai_response):
+    """Splits a model response into the part before the first score line and the scores/feedback part."""
+    # Only whole score lines count, so a comment such as [Comment: Spelling: ...] does not end the annotated part
+    m = SCORE_LINE_RE.search(ai_response)
+    if m:
+        return ai_response[:m.start()], ai_response[m.start():]
+    # Fallback if scores aren't found (maybe the model didn't follow instructions)
+    print("Warning: Could not reliably find score markers in AI response. Applying annotations to the whole response.")  # Console log
+    return ai_response, ""  # Assume no summary if markers are missing
+
+
+def parse_ai_response(ai_response, original, prechecks=None):
+    """Splits a raw model response into offset-based comments on the original essay, scores, grade and feedback sections."""
     # Isolate the annotated text part (everything before the first score line)
     # This helps prevent mark tags being added to the scores/summary sections
-    score_keywords = ["Grammar:", "Vocabulary:", "Coherence:", "Spelling:", "Structure:", "Grade:"]
-    end_of_annotation_index = -1
-    for keyword in score_keywords:
-        try:
-            index = ai_response.index(keyword)
-            if end_of_annotation_index == -1 or index < end_of_annotation_index:
-                end_of_annotation_index = index
-        except ValueError:
-            continue  # Keyword not found
-
-    if end_of_annotation_index != -1:
-        annotated_text_part = ai_response[:end_of_annotation_index]
-        summary_part = ai_response[end_of_annotation_index:]
-    else:
-        # Fallback if scores aren't found (maybe the model didn't follow instructions)
-        print("Warning: Could not reliably find score markers in AI response. Applying annotations to the whole response.")  # Console log
-        annotated_text_part = ai_response
-        summary_part = ""  # Assume no summary if markers are missing
-
-    # Add <mark> tags ONLY to the annotated text part
-    annotated_with_marks = re.sub(
-        r'(\[Comment:\s*.*?\])',  # Made regex slightly more specific
-        r'<mark>\1</mark>',
-        annotated_text_part,
-        flags=re.IGNORECASE | re.DOTALL  # Added IGNORECASE
-    )
-    # Combine the marked text with the rest of the response
-    full_annotated_response = annotated_with_marks + summary_part
+    annotated_text_part, summary_part = split_ai_response(ai_response)
+
+    # Take the comments out of the annotated text part and anchor them to the original essay,
+    # so the frontend and /download only need the comments, not a second copy of the essay
+    essay_text, essay_comments = extract_comments(annotated_text_part)
+    comments = align_comments_to_original(essay_text, essay_comments, original)
+    if prechecks:
+        # Pre-check issues are found in the original essay itself, so they need no alignment
+        comments = sorted(comments + find_precheck_comments(original, prechecks), key=lambda c: c["start"])
 
     # Parse rubric scores (search within the whole response)
     detailed_scores = {}
-    for crit in ["Grammar", "Vocabulary", "Coherence", "Spelling", "Structure"]:
+    for crit in SCORE_CRITERIA:
         # Regex: Look for the criterion name, optional colon, optional space, digits
         m = re.search(rf'^\s*{crit}\s*:\s*(\d{{1,3}})\s*$', ai_response, re.IGNORECASE | re.MULTILINE)
         detailed_scores[crit.lower()] = m.group(1) if m else "N/A"
@@ -478,24 +976,293 @@ Now, grade this essay strictly following all the rules above:
     print(f"--- Parsed Strengths: {strengths_text[:100]}... ---")  # Print first 100 chars
     print(f"--- Parsed Weaknesses: {weaknesses_text[:100]}... ---")
     print(f"--- Parsed Suggestions: {suggestions_text[:100]}... ---")
-    print(f"--- Analysis Complete. Grade: {grade} ---")  # Console log
 
-    # Return only the necessary parts to the frontend
-    # The full_annotated_response now includes the marked comments AND the summary/scores
-    return JSONResponse(content={
-        "original": content,
-        "annotated": full_annotated_response,  # Send the combined content
+    return {
+        "comments": comments,
+        "summary": summary_part,
         "grade": grade,
         "detailed_scores": detailed_scores,
         "strengths": strengths_text,
         "weaknesses": weaknesses_text,
         "suggestions": suggestions_text,
-    })
+    }
+
+
+def find_draft_problems(parsed, weights):
+    """Returns the reasons a draft grading looks inconsistent or low-confidence (empty if it looks fine)."""
+    problems = []
+    scores = parsed["detailed_scores"]
+    weighted_total = 0
+    for crit, weight in weights.items():
+        if not weight:
+            continue  # Criteria with no weight do not affect the grade
+        score = scores.get(crit, "N/A")
+        if score == "N/A" or int(score) > 100:
+            problems.append(f"Missing or invalid {crit.capitalize()} score.")
+            continue
+        weighted_total += int(score) * weight
+
+    grade = parsed["grade"]
+    if grade == "N/A" or int(grade) > 100:
+        problems.append("Missing or invalid overall Grade line.")
+    elif not problems and sum(weights.values()) > 0:
+        expected = weighted_total / sum(weights.values())
+        if abs(expected - int(grade)) > DRAFT_GRADE_TOLERANCE:
+            problems.append(f"Grade {grade} does not match the weighted rubric scores (about {expected:.0f}).")
+
+    if not any(c["source"] == "ai" for c in parsed["comments"]):  # Pre-check comments do not count
+        problems.append("No inline [Comment: ...] annotations were found.")
+    for section in ("strengths", "weaknesses", "suggestions"):
+        if parsed[section] == "Not provided" or not parsed[section]:
+            problems.append(f"The {section.capitalize()} section is missing.")
+    return problems
+
+
+REVIEW_REMOVE_RE = re.compile(r'^\W*REMOVE\s+(\d+)\W*$', re.IGNORECASE)
+REVIEW_REPLACE_RE = re.compile(r'^\W*REPLACE\s+(\d+)\s*:\s*(.+)$', re.IGNORECASE)
+REVIEW_ADD_RE = re.compile(r'^\W*ADD\s+after\s+["“](.+?)["”]\s*:\s*(.+)$', re.IGNORECASE)
+
+
+def as_comment(text):
+    """Wraps a reviewer's comment in [Comment: ...] unless it already is one."""
+    text = text.strip()
+    return text if COMMENT_RE.fullmatch(text) else f"[Comment: {text}]"
+
+
+def apply_comment_changes(draft_comments, changes_text, original):
+    """Applies the reviewer's REMOVE/REPLACE/ADD lines to the draft's offset-based comments."""
+    reviewable = reviewable_comments(draft_comments)
+    removed, replaced, added = set(), {}, []
+    for line in changes_text.splitlines():
+        remove_match = REVIEW_REMOVE_RE.match(line)
+        replace_match = REVIEW_REPLACE_RE.match(line)
+        add_match = REVIEW_ADD_RE.match(line)
+        if remove_match:
+            removed.add(int(remove_match.group(1)))
+        elif replace_match:
+            replaced[int(replace_match.group(1))] = as_comment(replace_match.group(2))
+        elif add_match:
+            # Anchor the new comment after the quoted essay text, allowing for different spacing or case
+            words = add_match.group(1).split()
+            quote = re.search(r"\s+".join(re.escape(w) for w in words), original, re.IGNORECASE)
+            if not quote:
+                print(f"Warning: Could not find reviewer quote in essay: {add_match.group(1)[:60]}")  # Console log
+                continue
+            added.append({"start": quote.end(), "end": quote.end(), "text": as_comment(add_match.group(2)), "source": "ai"})
+
+    comments = [c for c in draft_comments if c["source"] != "ai"]
+    for number, comment in enumerate(reviewable, 1):
+        if number in removed:
+            continue
+        comments.append({**comment, "text": replaced[number]} if number in replaced else comment)
+    return sorted(comments + added, key=lambda c: c["start"])
+
+
+def merge_review(draft, ai_response, original):
+    """Combines a draft grading with the reviewer's comment changes, scores and feedback."""
+    changes_text, _ = split_ai_response(ai_response)
+    reviewed = parse_ai_response(ai_response, original)
+    # Anything the reviewer left out is kept from the draft rather than shown as missing
+    detailed_scores = {
+        crit: score if score != "N/A" else draft["detailed_scores"][crit]
+        for crit, score in reviewed["detailed_scores"].items()
+    }
+    merged = {
+        "comments": apply_comment_changes(draft["comments"], changes_text, original),
+        "summary": reviewed["summary"] or draft["summary"],
+        "grade": reviewed["grade"] if reviewed["grade"] != "N/A" else draft["grade"],
+        "detailed_scores": detailed_scores,
+    }
+    for section in ("strengths", "weaknesses", "suggestions"):
+        merged[section] = reviewed[section] if reviewed[section] not in ("", "Not provided") else draft[section]
+    return merged
+
+
+async def read_essay_content(file, text_input):
+    """Returns the essay text from the pasted text or the uploaded file."""
+    content = None
+    if text_input:
+        content = text_input
+        print("--- Received text input from textarea ---")  # Console log
+    elif file:
+        try:
+            file_content_bytes = await file.read()
+            content = file_content_bytes.decode("utf-8")
+            print(f"--- Received file upload: {file.filename} ---")  # Console log
+        except Exception as e:
+            print(f"Error reading uploaded file: {e}")
+            raise HTTPException(status_code=400, detail=f"Invalid file upload or encoding: {e}")
+    else:
+        # This case should ideally be caught by frontend validation, but good to have backend check
+        print("Error: Neither file nor text_input provided.")  # Console log
+        raise HTTPException(status_code=400, detail="No essay content provided. Please upload a file or paste text.")
+
+    if not content:  # Should be redundant if logic above is correct, but as a safeguard
+        print("Error: Content is empty after checks.")  # Console log
+        raise HTTPException(status_code=400, detail="Essay content is empty.")
+    return content
+
+
+# Modify /analyze endpoint to accept ollama_url and ollama_model
+@app.post("/analyze")
+async def analyze(
+    file: UploadFile = File(None),  # Changed to None
+    text_input: str = Form(None),  # Added
+    ollama_url: str = Form(...),  # Added
+    ollama_model: str = Form(...),  # Added
+    draft_model: str = Form(""),  # Optional small model for draft-then-review grading
+    hedge_url: str = Form(""),  # Optional second Ollama server for hedged requests
+    local_prechecks: bool = Form(False),  # Run offline spelling/readability checks first
+    criteria: str = Form(""),
+    instructions: str = Form(""),
+    tone: str = Form("formal"),
+    strictness: str = Form("balanced"),
+    grade_level: str = Form(""),
+    weight_grammar: int = Form(25),
+    weight_vocabulary: int = Form(25),
+    weight_coherence: int = Form(25),
+    weight_spelling: int = Form(25),
+    weight_structure: int = Form(0)
+):
+    content = await read_essay_content(file, text_input)
+
+    weights = {
+        "grammar": weight_grammar,
+        "vocabulary": weight_vocabulary,
+        "coherence": weight_coherence,
+        "spelling": weight_spelling,
+        "structure": weight_structure,
+    }
+    # Basic validation for weights (optional but good practice)
+    total_weight = sum(weights.values())
+    if total_weight != 100:
+        print(f"Warning: Rubric weights do not sum to 100 (Sum: {total_weight})")  # Console log
+        # Decide if you want to raise an error or just proceed
+        # raise HTTPException(status_code=400, detail=f"Rubric weights must sum to 100, current sum is {total_weight}")
+
+    prechecks = run_local_prechecks(content, spelling_is_graded(criteria, weights)) if local_prechecks else None
+    precheck_note = build_precheck_note(prechecks) if prechecks else ""
+    prompt = build_grading_prompt(content, grade_level, tone, strictness, criteria, instructions, weights, precheck_note)
+
+    # With a draft model the small model grades first; the larger ollama_model only
+    # reviews the draft later (via /review) if the draft looks inconsistent
+    use_draft = bool(draft_model) and draft_model != ollama_model
+    model_name = draft_model if use_draft else ollama_model
+
+    print("--- Preparing to call Ollama for analysis ---")  # Console log
+    # Pass ollama_url and model name to the call function
+    draft_error = None
+    try:
+        ai_response = await request_ai_response(prompt, ollama_url, model_name, hedge_url)
+    except HTTPException as e:
+        if not use_draft:
+            raise
+        # e.g. the draft model is not pulled on this server; the main model can still grade
+        print(f"Draft model {draft_model} failed ({e.detail}), grading with {ollama_model} instead")  # Console log
+        draft_error = e.detail
+        use_draft = False
+        ai_response = await request_ai_response(prompt, ollama_url, ollama_model, hedge_url)
+    print("--- AI Response Received, Processing... ---")  # Console log
+    # print(f"Raw AI Response:\n{ai_response}\n--- End Raw AI Response ---") # Optional: log raw response for debugging
+
+    # --- Process AI Response ---
+    parsed = parse_ai_response(ai_response, content, prechecks)
+    print(f"--- Analysis Complete. Grade: {parsed['grade']} ---")  # Console log
+
+    review_problems = find_draft_problems(parsed, weights) if use_draft else []
+    if review_problems:
+        print(f"--- Draft from {draft_model} needs review: {review_problems} ---")  # Console log
+
+    # Return only the necessary parts to the frontend
+    # Comments are offsets into the original essay; the summary holds the scores and feedback text
+    result = {"original": content, **parsed}
+    if prechecks:
+        result["prechecks"] = prechecks
+    if draft_error:
+        result["graded_by"] = ollama_model
+        result["draft_error"] = draft_error
+    if use_draft:
+        result["graded_by"] = draft_model
+        result["review_pending"] = bool(review_problems)
+        if review_problems:
+            # The frontend posts these back to /review to upgrade the draft in place
+            result["draft_response"] = ai_response
+            result["review_problems"] = review_problems
+    return JSONResponse(content=result)
+
+
+@app.post("/review")
+async def review(
+    text_input: str = Form(...),
+    draft_response: str = Form(...),
+    review_problems: str = Form("[]"),  # JSON list returned by /analyze
+    ollama_url: str = Form(...),
+    ollama_model: str = Form(...),
+    hedge_url: str = Form(""),
+    local_prechecks: bool = Form(False),
+    criteria: str = Form(""),
+    instructions: str = Form(""),
+    tone: str = Form("formal"),
+    strictness: str = Form("balanced"),
+    grade_level: str = Form(""),
+    weight_grammar: int = Form(25),
+    weight_vocabulary: int = Form(25),
+    weight_coherence: int = Form(25),
+    weight_spelling: int = Form(25),
+    weight_structure: int = Form(0)
+):
+    """Has the larger model check and correct a draft grading produced by /analyze."""
+    weights = {
+        "grammar": weight_grammar,
+        "vocabulary": weight_vocabulary,
+        "coherence": weight_coherence,
+        "spelling": weight_spelling,
+        "structure": weight_structure,
+    }
+    try:
+        problems = json.loads(review_problems)
+    except json.JSONDecodeError:
+        print(f"Error decoding review_problems JSON: {review_problems}")
+        problems = []
+    if not isinstance(problems, list):
+        print(f"Warning: review_problems is not a JSON list: {review_problems[:100]}")
+        problems = []
+    problems = [p for p in problems if isinstance(p, str)]
+    if not problems:
+        problems = ["General consistency check requested."]
+
+    # Re-run the pre-checks so the review sees the same notes and the draft keeps the same local comments
+    prechecks = run_local_prechecks(text_input, spelling_is_graded(criteria, weights)) if local_prechecks else None
+    precheck_note = build_precheck_note(prechecks) if prechecks else ""
+    # The draft's comments are already anchored to the essay, so the reviewer only sends back changes
+    draft = parse_ai_response(draft_response, text_input, prechecks)
+    prompt = build_review_prompt(text_input, grade_level, tone, strictness, criteria, instructions, weights, precheck_note, draft, problems)
+
+    print(f"--- Reviewing draft with {ollama_model} ---")  # Console log
+    ai_response = await request_ai_response(prompt, ollama_url, ollama_model, hedge_url, context="/review")
+    parsed = merge_review(draft, ai_response, text_input)
+
+    remaining = find_draft_problems(parsed, weights)
+    if remaining:
+        print(f"Warning: Reviewed grading still has problems: {remaining}")  # Console log
+    print(f"--- Review Complete. Grade: {parsed['grade']} ---")  # Console log
+
+    result = {
+        "original": text_input,
+        **parsed,
+        "graded_by": ollama_model,
+        "review_pending": False,
+    }
+    if prechecks:
+        result["prechecks"] = prechecks
+    return JSONResponse(content=result)
 
 
 @app.post("/download")
 async def download_pdf(
-    annotated_html: str = Form(...),
+    annotated_html: str = Form(None),  # Legacy form, used when the teacher edited the essay text
+    comments: str = Form(None),  # JSON list of offset-based comments on original_essay
+    summary: str = Form(""),
     grade: str = Form(...),
     original_essay: str = Form(...),
     detailed_scores: str = Form(...),  # JSON string
@@ -503,10 +1270,23 @@ async def download_pdf(
     weaknesses: str = Form(...),
     suggestions: str = Form(...)
 ):
-    # Basic cleaning: remove potentially harmful script tags just in case
-    # It's generally better to use a proper HTML sanitizer if this were public-facing
-    # For our controlled environment, regex is a basic measure.
-    safe_annotated_html = re.sub(r'<script.*?>.*?</script>', '', annotated_html, flags=re.IGNORECASE | re.DOTALL)
+    if comments is not None:
+        # Compact form: rebuild the annotated essay from the original text and the comment offsets
+        try:
+            parsed_comments = json.loads(comments)
+        except json.JSONDecodeError:
+            print(f"Error decoding comments JSON: {comments[:100]}")
+            raise HTTPException(status_code=400, detail="Invalid comments JSON.")
+        if not isinstance(parsed_comments, list):
+            raise HTTPException(status_code=400, detail="Comments must be a JSON list.")
+        safe_annotated_html = render_annotated_html(original_essay, [c for c in parsed_comments if isinstance(c, dict)], summary)
+    elif annotated_html is not None:
+        # Basic cleaning: remove potentially harmful script tags just in case
+        # It's generally better to use a proper HTML sanitizer if this were public-facing
+        # For our controlled environment, regex is a basic measure.
+        safe_annotated_html = re.sub(r'<script.*?>.*?</script>', '', annotated_html, flags=re.IGNORECASE | re.DOTALL)
+    else:
+        raise HTTPException(status_code=400, detail="Either comments or annotated_html must be provided.")
 
     # Escape HTML characters in text content to prevent XSS or rendering issues
     # We'll use a simple escape for now, consider a more robust library for production
@@ -614,6 +1394,9 @@ mark {{ /* For AI comments */
   border-radius: 3px;
   font-size: 0.9em; /* Slightly smaller to differentiate */
 }}
+mark.ai-comment {{
+  margin-left: 0.25em; /* Space from the word the comment follows */
+}}
 .teacher-manual-annotation {{ /* Original text span highlighted by teacher */
   background-color: #e7f3fe; /* Light blue */
   border-bottom: 1px dashed #5b9bd5; /* Clearer dashed line */
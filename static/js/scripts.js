@@ -6,6 +6,11 @@ const presets = {
 
 const ollamaUrlInput = document.getElementById('ollama-url');
 const ollamaModelSelect = document.getElementById('ollama-model');
+const draftModelSelect = document.getElementById('draft-model');
+const hedgeUrlInput = document.getElementById('hedge-url');
+const reviewStatusDiv = document.getElementById('review-status');
+const precheckSummaryDiv = document.getElementById('precheck-summary');
+const localPrechecksCheckbox = document.getElementById('local-prechecks');
 const fetchModelsBtn = document.getElementById('fetch-models-btn');
 const modelFetchErrorDiv = document.getElementById('model-fetch-error');
 const analyzeErrorDiv = document.getElementById('analyze-error');
@@ -15,7 +20,8 @@ const uploadForm = document.getElementById('upload-form');
 // Data structure to hold analysis results for PDF generation
 let currentAnalysisData = {
     original: '',
-    annotated: '',
+    comments: [], // Offset-based AI and teacher comments on the original essay
+    summary: '', // Scores and feedback text shown after the annotated essay
     grade: '',
     detailed_scores: {},
     strengths: '',
@@ -23,6 +29,13 @@ let currentAnalysisData = {
     suggestions: ''
 };
 
+// Set when the teacher types in the annotated essay. The comment offsets no longer match the
+// text after that, so annotations, reviews and the PDF fall back to working on the DOM.
+let annotatedTextEdited = false;
+
+// Incremented on every Analyze click so late /analyze or /review responses from an earlier run are dropped
+let analysisToken = 0;
+
 // Preset Management Elements
 const presetNameInput = document.getElementById('preset-name');
 const savePresetBtn = document.getElementById('save-preset-btn');
@@ -42,6 +55,8 @@ fetchModelsBtn.addEventListener('click', async () => {
   }
   ollamaModelSelect.disabled = true;
   ollamaModelSelect.innerHTML = '<option value="">Fetching...</option>';
+  draftModelSelect.disabled = true;
+  draftModelSelect.innerHTML = '<option value="">-- None (single model) --</option>';
   modelFetchErrorDiv.textContent = '';
   fetchModelsBtn.disabled = true;
 
@@ -75,8 +90,14 @@ fetchModelsBtn.addEventListener('click', async () => {
             option.selected = true;
         }
         ollamaModelSelect.appendChild(option);
+
+        const draftOption = document.createElement('option');
+        draftOption.value = model;
+        draftOption.textContent = model;
+        draftModelSelect.appendChild(draftOption);
       });
       ollamaModelSelect.disabled = false;
+      draftModelSelect.disabled = false;
       if (!ollamaModelSelect.value && ollamaModelSelect.options.length > 0) {
           ollamaModelSelect.selectedIndex = 0;
       }
@@ -177,8 +198,36 @@ if (presetDropdown) {
 }
 
 function flattenTeacherComments() {
+  if (!annotatedTextEdited) {
+    // Offset model: embed each teacher comment after the last piece of its range, no DOM scan needed
+    const container = document.getElementById('annotated');
+    let fullRender = false;
+    currentAnalysisData.comments.forEach(c => {
+      if (c.source !== 'teacher' || c.embedded) return;
+      c.embedded = true;
+      const span = container.children[findPieceIndex(container, c.end - 1)];
+      if (!span || span.dataset.commentId !== c.id) {
+        fullRender = true; // Still rendering; the full render picks up the embedded flag
+        return;
+      }
+      container.insertBefore(createRenderNode({kind: 'embed', start: c.end, comment: c}), span.nextSibling);
+    });
+    if (fullRender) renderAnnotatedEssay(currentAnalysisData.original, currentAnalysisData.comments, currentAnalysisData.summary);
+    return;
+  }
+  // The teacher edited the text, so the DOM no longer matches the offsets; embed from the spans themselves
+  const commentsById = new Map(currentAnalysisData.comments.filter(c => c.id).map(c => [c.id, c]));
   document.querySelectorAll('.teacher-manual-annotation').forEach(span => {
     if(span.dataset.flattened) return;
+    if (span.dataset.commentId) {
+      // Annotation from the comment model: embed once, after the last piece of its range
+      const c = commentsById.get(span.dataset.commentId);
+      if (!c || c.embedded || !span.dataset.last) return;
+      c.embedded = true;
+      span.parentNode.insertBefore(createRenderNode({kind: 'embed', start: c.end, comment: c}), span.nextSibling);
+      span.dataset.flattened = "true";
+      return;
+    }
     const comment = span.getAttribute('title');
     if (!comment) return;
     const inline = document.createElement('mark');
@@ -232,8 +281,14 @@ uploadForm.addEventListener('submit', async e => {
 
   spinner.style.display='inline-block';
   document.getElementById('original').textContent = ''; // Clear previous results
+  renderToken++; // Stop any render still in progress
   document.getElementById('annotated').innerHTML = '';
   document.getElementById('grade').value = '';
+  reviewStatusDiv.textContent = '';
+  precheckSummaryDiv.textContent = '';
+  currentAnalysisData.comments = [];
+  annotatedTextEdited = false;
+  const token = ++analysisToken;
 
   try {
     const resp = await fetch('/analyze', { method: 'POST', body: data });
@@ -242,18 +297,48 @@ uploadForm.addEventListener('submit', async e => {
         throw new Error(`Analysis failed: ${errorData.detail || errorData.error || `HTTP ${resp.status}`}`);
      }
     const result = await resp.json();
+    if (token !== analysisToken) return; // A newer analysis was started meanwhile
 
     if (result.error) { // Handle application-level errors returned in JSON
         throw new Error(result.error);
     }
 
     document.getElementById('original').textContent = result.original;
-    document.getElementById('annotated').innerHTML = result.annotated;
+    showAnalysisResult(result);
+    showPrecheckSummary(result.prechecks);
+
+    if (result.draft_error) {
+      reviewStatusDiv.textContent = `Draft model failed (${result.draft_error}); graded by ${result.graded_by}.`;
+    } else if (result.graded_by) {
+      reviewStatusDiv.textContent = `Draft graded by ${result.graded_by}.`;
+    }
+    if (result.review_pending) {
+      // Show the draft now and upgrade it in place once the larger model has reviewed it
+      requestReview(data, result, token);
+    }
+
+  } catch (error) {
+      if (token !== analysisToken) return;
+      console.error("Analysis Error:", error);
+      analyzeErrorDiv.textContent = `Error: ${error.message}`;
+  } finally {
+      if (token === analysisToken) spinner.style.display='none';
+  }
+});
+
+// Renders an /analyze or /review result and keeps currentAnalysisData in sync
+function showAnalysisResult(result) {
+    if (!annotatedTextEdited) {
+      // Replace the AI comments but keep any annotations the teacher already added
+      const teacherComments = currentAnalysisData.comments.filter(c => c.source === 'teacher');
+      currentAnalysisData.comments = (result.comments || []).concat(teacherComments);
+      currentAnalysisData.summary = result.summary || '';
+      renderAnnotatedEssay(result.original, currentAnalysisData.comments, currentAnalysisData.summary);
+    }
     document.getElementById('grade').value = result.grade;
 
     // Populate currentAnalysisData
     currentAnalysisData.original = result.original;
-    currentAnalysisData.annotated = result.annotated;
     currentAnalysisData.grade = result.grade;
     currentAnalysisData.detailed_scores = result.detailed_scores || {}; // Ensure it's an object
     currentAnalysisData.strengths = result.strengths || 'Not provided';
@@ -261,21 +346,227 @@ uploadForm.addEventListener('submit', async e => {
     currentAnalysisData.suggestions = result.suggestions || 'Not provided';
 
     console.log("Updated currentAnalysisData:", currentAnalysisData); // For verification
+}
+
+// Shows the readability statistics and issue counts from the local pre-checks
+function showPrecheckSummary(prechecks) {
+  if (!prechecks) return;
+  const r = prechecks.readability || {};
+  let summary = `Local pre-checks: ${Object.keys(prechecks.misspelled).length} misspelled, ` +
+    `${prechecks.repeated_words.length} repeated words. ${r.words || 0} words, ${r.sentences || 0} sentences`;
+  if (r.flesch_kincaid_grade !== undefined) {
+    summary += `, Flesch reading ease ${r.flesch_reading_ease}, Flesch-Kincaid grade ${r.flesch_kincaid_grade}`;
+  }
+  summary += '.';
+  if (!prechecks.spell_checker_available) {
+    summary += ' Spell checking skipped (pyspellchecker is not installed on the server).';
+  } else if (!prechecks.spelling_checked) {
+    summary += ' Spell checking skipped (Spelling is not graded).';
+  }
+  precheckSummaryDiv.textContent = summary;
+}
+
+// --- Incremental Annotated Essay Rendering ---
+// Comments are kept as offsets into the original essay ({start, end, text, source}),
+// so rendering, annotating and downloading scale with the number of comments.
+const RENDER_ITEMS_PER_FRAME = 200; // DOM nodes appended per animation frame
+const RENDER_MAX_PIECE_CHARS = 2000; // Long stretches of plain text are split into pieces this size
+let renderToken = 0;
+let nextTeacherCommentId = 1;
+
+// Builds the list of text pieces and comment marks for original[from..to)
+function buildRenderItems(original, comments, from = 0, to = original.length) {
+  const points = new Map();
+  const teacher = [];
+  comments.forEach(c => {
+    if (c.source === 'teacher' && c.end > c.start) {
+      if (c.end > from && c.start < to) teacher.push(c);
+    } else if (c.start >= from && c.start <= to) {
+      if (!points.has(c.start)) points.set(c.start, []);
+      points.get(c.start).push(c);
+    }
+  });
+  teacher.sort((a, b) => a.start - b.start);
+
+  const cutSet = new Set([from, to, ...points.keys()]);
+  teacher.forEach(t => {
+    if (t.start > from) cutSet.add(t.start);
+    if (t.end < to) cutSet.add(t.end);
+  });
+  const cuts = [...cutSet].sort((a, b) => a - b);
+
+  const items = [];
+  // Marks exactly at the region edges belong to the neighbouring nodes when re-rendering a region
+  const wholeEssay = from === 0 && to === original.length;
+  if (wholeEssay) (points.get(0) || []).forEach(c => items.push({kind: 'ai', start: 0, comment: c}));
+  let t = 0;
+  for (let i = 0; i + 1 < cuts.length; i++) {
+    const a = cuts[i], b = cuts[i + 1];
+    while (t < teacher.length && teacher[t].end <= a) t++;
+    const current = (t < teacher.length && teacher[t].start <= a) ? teacher[t] : null;
+    for (let s = a; s < b; s += RENDER_MAX_PIECE_CHARS) {
+      const e = Math.min(b, s + RENDER_MAX_PIECE_CHARS);
+      items.push({kind: 'text', start: s, text: original.slice(s, e), teacher: current, last: !!current && e === current.end});
+    }
+    if (b === to && !wholeEssay) break;
+    if (current && current.end === b && current.embedded) items.push({kind: 'embed', start: b, comment: current});
+    (points.get(b) || []).forEach(c => items.push({kind: 'ai', start: b, comment: c}));
+  }
+  return items;
+}
+
+function createRenderNode(item) {
+  if (item.kind === 'text') {
+    const span = document.createElement('span');
+    span.dataset.start = item.start;
+    span.textContent = item.text;
+    if (item.teacher) {
+      span.className = 'teacher-manual-annotation';
+      span.title = item.teacher.text; // Store comment in title attribute
+      span.style.cursor = 'help'; // Shows the comment as a tooltip, like the legacy annotation path
+      span.dataset.commentId = item.teacher.id;
+      if (item.last) span.dataset.last = 'true';
+    }
+    return span;
+  }
+  const mark = document.createElement('mark');
+  mark.dataset.point = item.start;
+  if (item.kind === 'embed') {
+    mark.className = 'manual-comment-embed';
+    mark.textContent = ` [Manual Annotation: ${item.comment.text}]`;
+  } else {
+    mark.className = 'ai-comment';
+    mark.textContent = item.comment.text;
+  }
+  return mark;
+}
+
+// Renders the essay in chunks across animation frames so large essays stay responsive
+function renderAnnotatedEssay(original, comments, summary) {
+  const container = document.getElementById('annotated');
+  const token = ++renderToken;
+  container.innerHTML = '';
+  const items = buildRenderItems(original, comments);
+  let index = 0;
+
+  function renderChunk() {
+    if (token !== renderToken) return; // A newer render replaced this one
+    const fragment = document.createDocumentFragment();
+    const stop = Math.min(index + RENDER_ITEMS_PER_FRAME, items.length);
+    for (; index < stop; index++) fragment.appendChild(createRenderNode(items[index]));
+    container.appendChild(fragment);
+    if (index < items.length) {
+      requestAnimationFrame(renderChunk);
+    } else if (summary) {
+      const summaryDiv = document.createElement('div');
+      summaryDiv.className = 'annotation-summary';
+      summaryDiv.textContent = summary.trim();
+      container.appendChild(summaryDiv);
+    }
+  }
+  renderChunk();
+}
+
+function nodeEssayPosition(el) {
+  if (!el || !el.dataset) return Infinity;
+  if (el.dataset.start !== undefined) return parseInt(el.dataset.start, 10);
+  if (el.dataset.point !== undefined) return parseInt(el.dataset.point, 10);
+  return Infinity;
+}
+
+// Index of the top-level text piece containing essay offset pos (binary search over the pieces)
+function findPieceIndex(container, pos) {
+  const nodes = container.children;
+  let lo = 0, hi = nodes.length - 1, found = -1;
+  while (lo <= hi) {
+    const mid = (lo + hi) >> 1;
+    if (nodeEssayPosition(nodes[mid]) <= pos) { found = mid; lo = mid + 1; } else { hi = mid - 1; }
+  }
+  while (found >= 0 && nodes[found].dataset.start === undefined) found--; // Step back over marks
+  return found;
+}
+
+// Maps a DOM boundary point inside #annotated to an offset in the original essay, or null
+function essayOffsetAt(node, offset) {
+  if (node.nodeType === Node.TEXT_NODE) {
+    const el = node.parentElement;
+    if (el.dataset.start !== undefined) return parseInt(el.dataset.start, 10) + offset;
+    if (el.dataset.point !== undefined) return parseInt(el.dataset.point, 10);
+    return null;
+  }
+  const child = node.childNodes[offset];
+  if (child) {
+    const pos = nodeEssayPosition(child);
+    return pos === Infinity ? null : pos;
+  }
+  const last = node.lastChild;
+  if (last && last.dataset && last.dataset.start !== undefined) {
+    return parseInt(last.dataset.start, 10) + last.textContent.length;
+  }
+  return null;
+}
+
+// Re-renders only the text pieces covering original[start..end) after a comment changed there
+function rerenderRegion(start, end) {
+  const container = document.getElementById('annotated');
+  const first = findPieceIndex(container, start);
+  const lastIdx = findPieceIndex(container, end - 1);
+  if (first < 0 || lastIdx < first) {
+    renderAnnotatedEssay(currentAnalysisData.original, currentAnalysisData.comments, currentAnalysisData.summary);
+    return;
+  }
+  const nodes = container.children;
+  const from = parseInt(nodes[first].dataset.start, 10);
+  const to = parseInt(nodes[lastIdx].dataset.start, 10) + nodes[lastIdx].textContent.length;
+  const items = buildRenderItems(currentAnalysisData.original, currentAnalysisData.comments, from, to);
+  const fragment = document.createDocumentFragment();
+  items.forEach(item => fragment.appendChild(createRenderNode(item)));
+  const after = nodes[lastIdx].nextSibling;
+  for (let i = lastIdx; i >= first; i--) nodes[i].remove();
+  container.insertBefore(fragment, after);
+}
+
+// --- Review Draft with the Larger Model ---
+async function requestReview(analyzeData, draft, token) {
+  const reviewData = new FormData();
+  for (const [key, value] of analyzeData.entries()) {
+    if (key !== 'file' && key !== 'draft_model') reviewData.append(key, value);
+  }
+  reviewData.set('text_input', draft.original); // Send the text even if the essay was uploaded as a file
+  reviewData.set('draft_response', draft.draft_response);
+  reviewData.set('review_problems', JSON.stringify(draft.review_problems || []));
+
+  reviewStatusDiv.textContent = `Draft graded by ${draft.graded_by}. Reviewing with ${ollamaModelSelect.value}...`;
+  try {
+    const resp = await fetch('/review', { method: 'POST', body: reviewData });
+    if (!resp.ok) {
+      const errorData = await resp.json().catch(() => ({}));
+      throw new Error(errorData.detail || `HTTP ${resp.status}`);
+    }
+    const result = await resp.json();
 
+    // Ignore the review if a newer analysis has replaced this draft in the meantime,
+    // even one of the same essay with different settings
+    if (token !== analysisToken) return;
+
+    showAnalysisResult(result);
+    reviewStatusDiv.textContent = annotatedTextEdited
+      ? `Scores and feedback reviewed by ${result.graded_by}. Annotated essay kept because it was edited.`
+      : `Reviewed by ${result.graded_by}.`;
   } catch (error) {
-      console.error("Analysis Error:", error);
-      analyzeErrorDiv.textContent = `Error: ${error.message}`;
-  } finally {
-      spinner.style.display='none';
+    if (token !== analysisToken) return;
+    console.error("Review Error:", error);
+    reviewStatusDiv.textContent = `Review failed, showing draft from ${draft.graded_by}: ${error.message}`;
   }
-});
+}
 
 // --- Download PDF ---
 function downloadPDF() {
   // Retrieve data from currentAnalysisData
   const {
     original,
-    annotated, // This is the innerHTML of the annotated div, effectively annotated_html
+    comments,
+    summary,
     grade,
     detailed_scores,
     strengths,
@@ -283,15 +574,16 @@ function downloadPDF() {
     suggestions
   } = currentAnalysisData;
 
-  // The 'annotated' variable from currentAnalysisData already contains the HTML content.
-  // The 'grade' variable from currentAnalysisData contains the grade.
-  // No need to re-fetch from DOM if currentAnalysisData is up-to-date.
-  // const annotated_html_from_dom = document.getElementById('annotated').innerHTML;
-  // const grade_from_dom = document.getElementById('grade').value;
-
   const formData = new FormData();
   formData.append('original_essay', original);
-  formData.append('annotated_html', annotated); // Using data from currentAnalysisData
+  if (annotatedTextEdited) {
+    // The teacher changed the essay text itself, so only the DOM has the full picture
+    formData.append('annotated_html', document.getElementById('annotated').innerHTML);
+  } else {
+    // Compact form: the server rebuilds the annotated essay from the original and the offsets
+    formData.append('comments', JSON.stringify(comments.map(({id, ...c}) => c)));
+    formData.append('summary', summary);
+  }
   formData.append('grade', grade); // Using data from currentAnalysisData
   formData.append('detailed_scores', JSON.stringify(detailed_scores));
   formData.append('strengths', strengths);
@@ -391,6 +683,9 @@ function savePreset() {
   const settings = {
     ollamaUrl: ollamaUrlInput.value,
     ollamaModel: ollamaModelSelect.value,
+    draftModel: draftModelSelect.value,
+    hedgeUrl: hedgeUrlInput.value,
+    localPrechecks: localPrechecksCheckbox.checked,
     tone: document.getElementById('tone').value,
     strictness: document.getElementById('strictness').value,
     rubricPreset: document.getElementById('preset').value, // Rubric preset (AP, IELTS)
@@ -444,6 +739,9 @@ function applyPreset() {
   // Set model value. If the model isn't in the list, this will select nothing,
   // or user can manually fetch.
   ollamaModelSelect.value = settings.ollamaModel || "";
+  draftModelSelect.value = settings.draftModel || "";
+  hedgeUrlInput.value = settings.hedgeUrl || "";
+  localPrechecksCheckbox.checked = !!settings.localPrechecks;
 
 
   document.getElementById('tone').value = settings.tone;
@@ -517,6 +815,28 @@ function hideMenu(){document.getElementById('annotate-menu').style.display='none
 function saveAnnotation(){
   const comment=document.getElementById('comment-input').value.trim();
   if(!selectedRange || !comment) return hideMenu(); // Also hide if comment is empty
+
+  if (!annotatedTextEdited) {
+    // Record the annotation as offsets and re-render only the pieces it covers
+    const start = essayOffsetAt(selectedRange.startContainer, selectedRange.startOffset);
+    const end = essayOffsetAt(selectedRange.endContainer, selectedRange.endOffset);
+    hideMenu();
+    selectedRange = null; // Clear selection after applying
+    window.getSelection().removeAllRanges(); // Deselect text
+    if (start === null || end === null || end <= start) {
+      console.warn("Selection could not be mapped to the essay text.");
+      return;
+    }
+    const overlaps = currentAnalysisData.comments.some(c => c.source === 'teacher' && c.start < end && start < c.end);
+    if (overlaps) {
+      alert('This selection overlaps an existing teacher annotation.');
+      return;
+    }
+    currentAnalysisData.comments.push({start, end, text: comment, source: 'teacher', id: 't' + nextTeacherCommentId++});
+    rerenderRegion(start, end);
+    return;
+  }
+
   const span=document.createElement('span');
   span.className='teacher-manual-annotation';
   span.title=comment; // Store comment in title attribute
@@ -536,6 +856,8 @@ function saveAnnotation(){
   }
 }
 
+document.getElementById('annotated').addEventListener('input', () => { annotatedTextEdited = true; });
+
 document.getElementById('annotated').addEventListener('mouseup',e=>{
   const sel=window.getSelection();
   if(!sel || sel.isCollapsed || !sel.rangeCount) return;
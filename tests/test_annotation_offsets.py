@@ -0,0 +1,94 @@
+
+import main6_revised as grader
+
+
+def aligned(annotated, original):
+    essay_text, comments = grader.extract_comments(annotated)
+    return [(c["start"], c["text"]) for c in grader.align_comments_to_original(essay_text, comments, original)]
+
+
+def test_extract_comments():
+    text, comments = grader.extract_comments("One [Comment: a] two[comment: b]\nthree")
+    assert text == "One  two\nthree"
+    assert comments == [(4, "[Comment: a]"), (8, "[comment: b]")]
+
+
+def test_extract_multiline_comment():
+    text, comments = grader.extract_comments("Word [Comment: spans\ntwo lines] end")
+    assert text == "Word  end"
+    assert comments == [(5, "[Comment: spans\ntwo lines]")]
+
+
+def test_identical_copy():
+    assert aligned("The cat sat. [Comment: ok]", "The cat sat.") == [(12, "[Comment: ok]")]
+
+
+def test_reflowed_whitespace():
+    original = "The cat\n\nsat   on the mat."
+    assert aligned("The cat [Comment: a] sat on the mat. [Comment: b]", original) == [
+        (7, "[Comment: a]"), (len(original), "[Comment: b]"),
+    ]
+
+
+def test_changed_and_inserted_words():
+    original = "I has a dog. It runs fast."
+    # The model fixed "has" and inserted "very"
+    annotated = "I have [Comment: verb] a dog. It runs very [Comment: adverb] fast."
+    assert aligned(annotated, original) == [(5, "[Comment: verb]"), (20, "[Comment: adverb]")]
+
+
+def test_comment_before_first_word():
+    assert aligned("[Comment: Good title.] My essay.", "My essay.") == [(0, "[Comment: Good title.]")]
+
+
+def render(comments, original="Hello brave new world.", summary=""):
+    return grader.render_annotated_html(original, comments, summary)
+
+
+def test_render_ai_comments():
+    html_out = render([{"start": 5, "end": 5, "text": "[Comment: hi]", "source": "ai"},
+                       {"start": 0, "end": 0, "text": "[Comment: start]", "source": "ai"}])
+    assert html_out == ('<mark class="ai-comment">[Comment: start]</mark>Hello'
+                        '<mark class="ai-comment">[Comment: hi]</mark> brave new world.')
+
+
+def test_render_teacher_ranges():
+    html_out = render([
+        {"start": 6, "end": 11, "text": "nice", "source": "teacher", "embedded": True},
+        {"start": 12, "end": 15, "text": "hidden", "source": "teacher"},
+        {"start": 8, "end": 8, "text": "[Comment: mid]", "source": "ai"},
+    ])
+    assert html_out == (
+        'Hello <span class="teacher-manual-annotation">br</span><mark class="ai-comment">[Comment: mid]</mark>'
+        '<span class="teacher-manual-annotation">ave</span>'
+        '<mark class="manual-comment-embed"> [Manual Annotation: nice]</mark> '
+        '<span class="teacher-manual-annotation">new</span> world.'
+    )
+
+
+def test_render_drops_overlapping_teacher_range():
+    html_out = render([
+        {"start": 0, "end": 11, "text": "first", "source": "teacher"},
+        {"start": 6, "end": 15, "text": "overlap", "source": "teacher"},
+    ])
+    assert html_out.count("teacher-manual-annotation") == 1
+
+
+def test_render_skips_malformed_comments():
+    html_out = render([
+        {"start": "x", "text": "[Comment: bad]"},
+        {"start": None, "text": "[Comment: none]"},
+        {"start": 999, "end": -5, "text": "[Comment: clamped]", "source": "ai"},
+    ])
+    assert "bad" not in html_out and "none" not in html_out
+    assert html_out.endswith('world.<mark class="ai-comment">[Comment: clamped]</mark>')
+
+
+def test_render_escapes_html():
+    html_out = render([{"start": 3, "end": 3, "text": "[Comment: <script>x</script>]", "source": "ai"},
+                       {"start": 0, "end": 3, "text": "<b>", "source": "teacher", "embedded": True}],
+                      original="<i> & more", summary="Grade: 5 <b>")
+    assert "<script>" not in html_out and "<i>" not in html_out and "<b>" not in html_out
+    assert "&lt;script&gt;" in html_out
+    assert "&lt;i&gt;" in html_out
+    assert html_out.endswith("\n\nGrade: 5 &lt;b&gt;")
@@ -0,0 +1,237 @@
+import asyncio
+import json
+
+import pytest
+
+import main6_revised as grader
+
+WEIGHTS = {"grammar": 25, "vocabulary": 25, "coherence": 25, "spelling": 25, "structure": 0}
+
+RESPONSE = """I has a dog. [Comment: Use "have".]
+Grammar: 80
+Vocabulary: 70
+Coherence: 90
+Spelling: 60
+Structure: 0
+Grade: 75/100
+Strengths:
+Clear topic.
+Weaknesses:
+Verb agreement.
+Suggestions for improvement:
+Proofread.
+"""
+
+
+def parsed(response=RESPONSE, original="I has a dog."):
+    return grader.parse_ai_response(response, original)
+
+
+def test_parse_ai_response_sections():
+    result = parsed()
+    assert result["grade"] == "75"
+    assert result["detailed_scores"] == {
+        "grammar": "80", "vocabulary": "70", "coherence": "90", "spelling": "60", "structure": "0",
+    }
+    assert result["strengths"] == "Clear topic."
+    assert result["weaknesses"] == "Verb agreement."
+    assert result["suggestions"] == "Proofread."
+    assert result["summary"].startswith("Grammar: 80")
+
+
+def test_parse_ai_response_missing_scores():
+    result = parsed("Just some text without scores.", "Just some text without scores.")
+    assert result["grade"] == "N/A"
+    assert set(result["detailed_scores"].values()) == {"N/A"}
+    assert result["strengths"] == "Not provided"
+    assert result["summary"] == ""
+
+
+def test_consistent_draft_has_no_problems():
+    assert grader.find_draft_problems(parsed(), WEIGHTS) == []
+
+
+def test_grade_within_tolerance_is_accepted():
+    result = parsed(RESPONSE.replace("Grade: 75/100", f"Grade: {75 + grader.DRAFT_GRADE_TOLERANCE}/100"))
+    assert grader.find_draft_problems(result, WEIGHTS) == []
+
+
+def test_grade_outside_tolerance_is_flagged():
+    result = parsed(RESPONSE.replace("Grade: 75/100", f"Grade: {75 + grader.DRAFT_GRADE_TOLERANCE + 1}/100"))
+    problems = grader.find_draft_problems(result, WEIGHTS)
+    assert len(problems) == 1
+    assert "does not match" in problems[0]
+
+
+def test_missing_weighted_score_is_flagged():
+    result = parsed(RESPONSE.replace("Spelling: 60\n", ""))
+    assert any("Spelling" in p for p in grader.find_draft_problems(result, WEIGHTS))
+
+
+def test_missing_score_with_zero_weight_is_ignored():
+    result = parsed(RESPONSE.replace("Structure: 0\n", ""))
+    assert result["detailed_scores"]["structure"] == "N/A"
+    assert grader.find_draft_problems(result, WEIGHTS) == []
+
+
+def test_missing_grade_and_sections_are_flagged():
+    response = RESPONSE.split("Grade:")[0]
+    problems = grader.find_draft_problems(parsed(response), WEIGHTS)
+    assert any("Grade" in p for p in problems)
+    assert any("Strengths" in p for p in problems)
+
+
+def test_draft_without_comments_is_flagged():
+    result = parsed(RESPONSE.replace(' [Comment: Use "have".]', ""))
+    assert any("annotations" in p for p in grader.find_draft_problems(result, WEIGHTS))
+
+
+def run_review(monkeypatch, review_problems, reply=RESPONSE):
+    prompts = []
+
+    async def fake_request(prompt, ollama_url, model_name, hedge_url="", context="/analyze"):
+        prompts.append(prompt)
+        return reply
+
+    monkeypatch.setattr(grader, "request_ai_response", fake_request)
+    response = asyncio.run(grader.review(
+        text_input="I has a dog.", draft_response=RESPONSE, review_problems=review_problems,
+        ollama_url="http://ollama", ollama_model="big", hedge_url="", local_prechecks=False,
+        criteria="", instructions="", tone="formal", strictness="balanced", grade_level="",
+        weight_grammar=25, weight_vocabulary=25, weight_coherence=25, weight_spelling=25, weight_structure=0,
+    ))
+    return prompts[0], json.loads(response.body)
+
+
+@pytest.mark.parametrize("review_problems", ["5", '"abc"', "null", "{}", "not json"])
+def test_review_ignores_problems_that_are_not_a_list(monkeypatch, review_problems):
+    prompt, result = run_review(monkeypatch, review_problems)
+    assert "- General consistency check requested." in prompt
+    assert "- a\n" not in prompt
+    assert result["grade"] == "75"
+
+
+def test_review_keeps_only_string_problems(monkeypatch):
+    prompt, _ = run_review(monkeypatch, json.dumps(["Grade is off.", 3, None, {"x": 1}]))
+    assert "- Grade is off." in prompt
+    assert "- 3" not in prompt
+    assert "- None" not in prompt
+
+
+DRAFT_RESPONSE = """I has a dog. [Comment: Use "have".] It run fast. [Comment: Nice verb.]
+Grammar: 80
+Vocabulary: 70
+Coherence: 90
+Spelling: 60
+Structure: 0
+Grade: 95/100
+Strengths:
+Clear topic.
+Weaknesses:
+Verb agreement.
+Suggestions for improvement:
+Proofread.
+"""
+DRAFT_ORIGINAL = "I has a dog. It run fast."
+
+REVIEW_REPLY = """Comment changes:
+REPLACE 2: [Comment: Use "runs".]
+ADD after "a  DOG": [Comment: Spelling: fine.]
+ADD after "not in the essay": [Comment: Lost.]
+Grammar: 60
+Vocabulary: 70
+Coherence: 90
+Spelling: 60
+Structure: 0
+Grade: 70/100
+Weaknesses:
+Verb agreement in two sentences.
+"""
+
+
+def test_review_prompt_lists_draft_comments_instead_of_the_draft():
+    draft = grader.parse_ai_response(DRAFT_RESPONSE, DRAFT_ORIGINAL)
+    prompt = grader.build_review_prompt(
+        DRAFT_ORIGINAL, "", "formal", "balanced", "", "", WEIGHTS, "", draft, ["Grade is off."],
+    )
+    assert "--- ESSAY START ---\nI has a dog. It run fast.\n--- ESSAY END ---" in prompt
+    assert '[Comment: Use "have".] It run' not in prompt
+    assert '1. after "I has a dog.": [Comment: Use "have".]' in prompt
+    assert '2. after "I has a dog. It run fast.": [Comment: Nice verb.]' in prompt
+    assert "Grade: 95/100" in prompt
+    assert "DO NOT repeat the essay" in prompt
+
+
+def test_comment_line_inside_annotations_does_not_end_them():
+    annotated, summary = grader.split_ai_response("A b. [Comment: Spelling: 5 errors.]\nSpelling: 40\nGrade: 40")
+    assert annotated == "A b. [Comment: Spelling: 5 errors.]\n"
+    assert summary.startswith("Spelling: 40")
+
+
+def test_apply_comment_changes():
+    draft = grader.parse_ai_response(DRAFT_RESPONSE, DRAFT_ORIGINAL)
+    precheck = {"start": 1, "end": 1, "text": "[Comment: Spelling: x]", "source": "precheck"}
+    changes = 'REMOVE 1\nREPLACE 2: Use "runs".\nADD after "It": [Comment: New.]\nADD after "missing": x'
+    comments = grader.apply_comment_changes(draft["comments"] + [precheck], changes, DRAFT_ORIGINAL)
+    assert [(c["start"], c["text"], c["source"]) for c in comments] == [
+        (1, "[Comment: Spelling: x]", "precheck"),
+        (15, "[Comment: New.]", "ai"),
+        (25, '[Comment: Use "runs".]', "ai"),
+    ]
+
+
+def test_merge_review_keeps_draft_comments_and_missing_sections():
+    draft = grader.parse_ai_response(DRAFT_RESPONSE, DRAFT_ORIGINAL)
+    merged = grader.merge_review(draft, REVIEW_REPLY, DRAFT_ORIGINAL)
+    assert [(c["start"], c["text"]) for c in merged["comments"]] == [
+        (11, "[Comment: Spelling: fine.]"),
+        (12, '[Comment: Use "have".]'),
+        (25, '[Comment: Use "runs".]'),
+    ]
+    assert merged["grade"] == "70"
+    assert merged["detailed_scores"]["grammar"] == "60"
+    assert merged["weaknesses"] == "Verb agreement in two sentences."
+    assert merged["strengths"] == "Clear topic."
+    assert merged["summary"].startswith("Grammar: 60")
+
+
+def test_review_endpoint_merges_reply_into_draft(monkeypatch):
+    prompt, result = run_review(monkeypatch, json.dumps(["Grade is off."]), reply="Comment changes:\nREMOVE 1\n" + RESPONSE.split("]\n", 1)[1])
+    assert "--- ESSAY START ---\nI has a dog.\n--- ESSAY END ---" in prompt
+    assert result["comments"] == []
+    assert result["grade"] == "75"
+    assert result["graded_by"] == "big"
+    assert result["review_pending"] is False
+
+
+def run_analyze(monkeypatch, failing_models):
+    models = []
+
+    async def fake_request(prompt, ollama_url, model_name, hedge_url="", context="/analyze"):
+        models.append(model_name)
+        if model_name in failing_models:
+            raise grader.HTTPException(status_code=503, detail=f"model '{model_name}' not found")
+        return RESPONSE
+
+    monkeypatch.setattr(grader, "request_ai_response", fake_request)
+    response = asyncio.run(grader.analyze(
+        file=None, text_input="I has a dog.", ollama_url="http://ollama", ollama_model="big",
+        draft_model="small", hedge_url="", local_prechecks=False, criteria="", instructions="",
+        tone="formal", strictness="balanced", grade_level="",
+        weight_grammar=25, weight_vocabulary=25, weight_coherence=25, weight_spelling=25, weight_structure=0,
+    ))
+    return models, json.loads(response.body)
+
+
+def test_analyze_falls_back_to_main_model_when_draft_model_fails(monkeypatch):
+    models, result = run_analyze(monkeypatch, {"small"})
+    assert models == ["small", "big"]
+    assert result["graded_by"] == "big"
+    assert "not found" in result["draft_error"]
+    assert "review_pending" not in result
+    assert result["grade"] == "75"
+
+
+def test_analyze_reports_main_model_failure(monkeypatch):
+    with pytest.raises(grader.HTTPException):
+        run_analyze(monkeypatch, {"small", "big"})
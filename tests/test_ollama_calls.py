@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+import main6_revised as grader
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, chunks=(), token_delay=0, error=None):
+        self.status_code = status_code
+        self.chunks = list(chunks)
+        self.token_delay = token_delay
+        self.error = error
+        self.closed = False
+        self.content = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"HTTP {self.status_code}", response=self)
+
+    def json(self):
+        return {}
+
+    @property
+    def text(self):
+        return ""
+
+    def iter_lines(self):
+        if self.error:
+            raise self.error
+        for i, chunk in enumerate(self.chunks):
+            time.sleep(self.token_delay)
+            yield json.dumps({"message": {"content": chunk}, "done": i == len(self.chunks) - 1}).encode()
+
+
+class FakeOllama:
+    """Replaces requests.Session; each server URL answers with the next queued response."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def post(self, url, json=None, timeout=None, stream=False):
+        with self.lock:
+            self.calls.append(url)
+            queue = self.responses[url.split("/api/")[0]]
+            response = queue.pop(0) if len(queue) > 1 else queue[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(grader, "OLLAMA_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(grader, "_ollama_latencies", {})
+
+
+def install(monkeypatch, responses):
+    fake = FakeOllama(responses)
+    monkeypatch.setattr(grader.requests, "Session", fake)
+    return fake
+
+
+def test_retryable_status_is_retried(monkeypatch):
+    fake = install(monkeypatch, {"http://a": [FakeResponse(503), FakeResponse(chunks=["ok"])]})
+    assert grader.call_ollama("prompt", "http://a", "m") == "ok"
+    assert len(fake.calls) == 2
+
+
+def test_connection_error_is_retried(monkeypatch):
+    fake = install(monkeypatch, {"http://a": [requests.exceptions.ConnectionError("reset"), FakeResponse(chunks=["ok"])]})
+    assert grader.call_ollama("prompt", "http://a", "m") == "ok"
+    assert len(fake.calls) == 2
+
+
+def test_not_found_is_not_retried(monkeypatch):
+    fake = install(monkeypatch, {"http://a": [FakeResponse(404)]})
+    with pytest.raises(RuntimeError, match="Ollama API error"):
+        grader.call_ollama("prompt", "http://a", "m")
+    assert len(fake.calls) == 1
+
+
+def test_attempts_are_capped(monkeypatch):
+    fake = install(monkeypatch, {"http://a": [requests.exceptions.ConnectionError("down")]})
+    with pytest.raises(RuntimeError, match="Cannot connect"):
+        grader.call_ollama("prompt", "http://a", "m")
+    assert len(fake.calls) == grader.OLLAMA_MAX_ATTEMPTS
+
+
+def test_deadline_stops_slow_generation(monkeypatch):
+    install(monkeypatch, {"http://a": [FakeResponse(chunks=["a"] * 50, token_delay=0.02)]})
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="timed out"):
+        grader.call_ollama("prompt", "http://a", "m", deadline_seconds=0.1)
+    assert time.monotonic() - start < 1
+
+
+def test_error_reported_mid_stream(monkeypatch):
+    install(monkeypatch, {"http://a": [FakeResponse(error=RuntimeError("Ollama API error: model not found"))]})
+    with pytest.raises(RuntimeError, match="model not found"):
+        grader.call_ollama("prompt", "http://a", "m")
+
+
+def seed_latency(url, seconds_per_k):
+    data = {"model": "m", "messages": [{"content": "x"}]}
+    for _ in range(grader.OLLAMA_MIN_SAMPLES_FOR_HEDGE):
+        grader._record_latency(url, data, seconds_per_k)
+
+
+def test_hedge_threshold_scales_with_prompt_size():
+    seed_latency("http://a", 1.0)
+    short = {"model": "m", "messages": [{"content": "x" * 500}]}
+    long = {"model": "m", "messages": [{"content": "x" * 10000}]}
+    assert grader._hedge_delay("http://a", short) == pytest.approx(1.0)
+    assert grader._hedge_delay("http://a", long) == pytest.approx(10.0)
+
+
+def test_no_hedge_without_history(monkeypatch):
+    fake = install(monkeypatch, {
+        "http://a": [FakeResponse(chunks=["primary"])],
+        "http://b": [FakeResponse(chunks=["hedge"])],
+    })
+    assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "primary"
+    assert fake.calls == ["http://a/api/chat"]
+
+
+def test_hedge_wins_and_primary_is_cancelled(monkeypatch):
+    slow = FakeResponse(chunks=["slow"] * 20, token_delay=0.05)
+    install(monkeypatch, {
+        "http://a": [slow],
+        "http://b": [FakeResponse(chunks=["hedge"])],
+    })
+    seed_latency("http://a", 0.01)
+    assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "hedge"
+    time.sleep(0.2)  # Give the primary thread time to notice the cancellation
+    assert slow.closed
+
+
+def test_primary_wins_when_hedge_fails(monkeypatch):
+    install(monkeypatch, {
+        "http://a": [FakeResponse(chunks=["primary"], token_delay=0.1)],
+        "http://b": [FakeResponse(404)],
+    })
+    seed_latency("http://a", 0.01)
+    assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "primary"
+
+
+def test_hedged_rounds_do_not_lower_the_threshold(monkeypatch):
+    # Half the calls are slow and get hedged; the fast half alone would pull the p95 down
+    fast = FakeResponse(chunks=["fast"], token_delay=0.01)
+    slow = FakeResponse(chunks=["slow"] * 20, token_delay=0.05)
+    install(monkeypatch, {
+        "http://a": [fast, slow] * 6,
+        "http://b": [FakeResponse(chunks=["hedge"])],
+    })
+    monkeypatch.setattr(grader, "OLLAMA_LATENCY_SAMPLES", 6)
+    data = {"model": "m", "messages": [{"content": "x"}]}
+    for _ in range(6):
+        grader._record_latency("http://a", data, 0.1)
+
+    for _ in range(6):
+        assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "fast"
+        assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "hedge"
+        time.sleep(0.2)  # Let the cancelled primary record its duration
+        assert grader._hedge_delay("http://a", data) >= 0.1
+
+
+def test_hedge_is_tried_when_primary_fails_early(monkeypatch):
+    fake = install(monkeypatch, {
+        "http://a": [requests.exceptions.ConnectionError("refused")],
+        "http://b": [FakeResponse(chunks=["hedge"])],
+    })
+    seed_latency("http://a", 10.0)
+    assert grader.call_ollama("prompt", "http://a", "m", hedge_url="http://b") == "hedge"
+    assert fake.calls.count("http://b/api/chat") == 1
@@ -0,0 +1,134 @@
+import pytest
+
+import main6_revised as grader
+
+
+class FakeChecker:
+    """Stands in for pyspellchecker with a tiny fixed dictionary."""
+
+    WORDS = {
+        "the", "dog", "ran", "had", "that", "he", "said", "was", "fine", "color", "a", "letter", "i", "receive",
+        "it", "isn't", "couldn't", "i've", "go", "café", "women", "children", "rights", "and",
+    }
+
+    def unknown(self, words):
+        return {w for w in words if w not in self.WORDS}
+
+    def known(self, words):
+        return {w for w in words if w in self.WORDS}
+
+    def correction(self, word):
+        return {"teh": "the", "recieve": "receive"}.get(word)
+
+
+@pytest.fixture
+def fake_checker(monkeypatch):
+    monkeypatch.setattr(grader, "SpellChecker", FakeChecker)
+    monkeypatch.setattr(grader, "_spell_checker", FakeChecker())
+
+
+def test_allowed_repeats_are_not_flagged(fake_checker):
+    result = grader.run_local_prechecks("He had had enough. He said that that was fine. The the dog ran.")
+    assert result["repeated_words"] == ["the"]
+
+
+def test_capitalized_words_are_skipped(fake_checker):
+    result = grader.run_local_prechecks("Zorblat ran. the dog ran teh way.")
+    assert "zorblat" not in result["misspelled"]
+    assert result["misspelled"]["teh"] == "the"
+
+
+def test_regional_variants_are_not_flagged(fake_checker):
+    result = grader.run_local_prechecks("the colour was fine")
+    assert result["misspelled"] == {}
+
+
+def test_spelling_skipped_when_not_graded(fake_checker):
+    result = grader.run_local_prechecks("the dog ran teh way", check_spelling=False)
+    assert result["misspelled"] == {}
+    assert result["spell_checker_available"] is True
+    assert result["spelling_checked"] is False
+
+
+def test_missing_dictionary_falls_back(monkeypatch):
+    monkeypatch.setattr(grader, "SpellChecker", None)
+    monkeypatch.setattr(grader, "_spell_checker", None)
+    result = grader.run_local_prechecks("the the dog ran teh way.")
+    assert result["spell_checker_available"] is False
+    assert result["misspelled"] == {}
+    assert result["repeated_words"] == ["the"]
+    assert result["readability"]["words"] == 6
+
+
+def test_spelling_is_graded():
+    assert grader.spelling_is_graded("grammar, spelling", {"spelling": 20})
+    assert not grader.spelling_is_graded("grammar, vocabulary", {"spelling": 20})
+    assert not grader.spelling_is_graded("spelling", {"spelling": 0})
+
+
+def test_note_does_not_ask_to_penalize(fake_checker):
+    note = grader.build_precheck_note(grader.run_local_prechecks("the dog ran teh way."))
+    assert "teh" in note
+    assert "count them" not in note
+
+
+def test_british_spellings_with_real_dictionary(monkeypatch):
+    checker_module = pytest.importorskip("spellchecker")
+    monkeypatch.setattr(grader, "SpellChecker", checker_module.SpellChecker)
+    monkeypatch.setattr(grader, "_spell_checker", None)
+    result = grader.run_local_prechecks("the colour and behaviour of the centre; we organise and analyse, then recieve it.")
+    assert list(result["misspelled"]) == ["recieve"]
+
+
+def test_curly_apostrophes_and_accents(fake_checker):
+    result = grader.run_local_prechecks("it isn’t the café, i couldn’t go. i’ve said that café café was fine.")
+    assert result["misspelled"] == {}
+    assert result["repeated_words"] == ["café"]
+    assert result["readability"]["words"] == 14
+
+
+def test_possessives_use_the_base_word(fake_checker):
+    result = grader.run_local_prechecks("the women's and the children’s rights, the dgo's letter")
+    assert list(result["misspelled"]) == ["dgo's"]
+
+
+def test_curly_misspelling_is_anchored(fake_checker):
+    original = "the dog did’nt go."
+    prechecks = grader.run_local_prechecks(original)
+    assert list(prechecks["misspelled"]) == ["did'nt"]
+    assert [c["start"] for c in grader.find_precheck_comments(original, prechecks)] == [14]
+
+
+def test_contractions_accents_and_possessives_with_real_dictionary(monkeypatch):
+    checker_module = pytest.importorskip("spellchecker")
+    monkeypatch.setattr(grader, "SpellChecker", checker_module.SpellChecker)
+    monkeypatch.setattr(grader, "_spell_checker", None)
+    result = grader.run_local_prechecks(
+        "it isn’t fair, they couldn’t go and didn’t ask; i’ve seen the café. the women's and children's rights."
+    )
+    assert result["misspelled"] == {}
+
+
+def test_precheck_comments_are_anchored_in_original(fake_checker):
+    original = "I recieve teh letter."
+    comments = grader.find_precheck_comments(original, grader.run_local_prechecks(original))
+    assert [(c["start"], c["source"]) for c in comments] == [(9, "precheck"), (13, "precheck")]
+    assert "did you mean \"the\"" in comments[1]["text"]
+
+
+def test_model_comments_are_not_rewritten(fake_checker):
+    original = "I recieve teh letter."
+    response = 'I recieve teh letter. [Comment: "teh" and "recieve" are typos.]\nGrade: 50/100\n'
+    result = grader.parse_ai_response(response, original, grader.run_local_prechecks(original))
+    ai_comments = [c for c in result["comments"] if c["source"] == "ai"]
+    assert ai_comments == [{"start": 21, "end": 21, "text": '[Comment: "teh" and "recieve" are typos.]', "source": "ai"}]
+    assert [c["start"] for c in result["comments"] if c["source"] == "precheck"] == [9, 13]
+
+
+def test_precheck_comments_alone_still_need_review(fake_checker):
+    original = "I recieve teh letter."
+    response = "I recieve teh letter.\nGrammar: 50\nGrade: 50/100\nStrengths:\na\nWeaknesses:\nb\nSuggestions for improvement:\nc\n"
+    result = grader.parse_ai_response(response, original, grader.run_local_prechecks(original))
+    assert result["comments"]
+    problems = grader.find_draft_problems(result, {"grammar": 100, "vocabulary": 0, "coherence": 0, "spelling": 0, "structure": 0})
+    assert any("annotations" in p for p in problems)